@@ -0,0 +1,10 @@
+import os
+import sys
+
+# main.py reads these at import time; the tests never reach the real services
+os.environ.setdefault("GOOGLE_SHEET_WEBHOOK", "http://127.0.0.1:9/exec")
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("GOOGLE_SERVICE_JSON", "{}")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
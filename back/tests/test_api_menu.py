@@ -0,0 +1,65 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+MENU = [
+    {"Dish": "Paneer Tikka", "Category": "Starter", "Price": "₹200", "Time": "15"},
+    {"Dish": "Dal Tadka", "Category": "Main Course", "Price": "150", "Time": "20"},
+    {"Dish": "Broken Row", "Category": "Main Course", "Price": "", "Time": ""},
+]
+SHEETS = {
+    "menu": MENU,
+    "table": [{"Table": "T1", "Availability": "Yes"}, {"Table": "T2", "Availability": "Yes"}],
+    "orders": [
+        {"Customer_ID": "a@x.com", "Dish": "Paneer Tikka", "Ordered_At": "2025-01-01 12:00"},
+        {"Customer_ID": "a@x.com", "Dish": "Paneer Roll", "Ordered_At": "2025-01-02 12:00"},
+    ],
+}
+
+
+class FakeStorage:
+    def __init__(self):
+        self.reads = []
+
+    def read(self, sheet_name):
+        self.reads.append(sheet_name)
+        return [dict(row) for row in SHEETS.get(sheet_name, [])]
+
+    async def aread(self, sheet_name):
+        return self.read(sheet_name)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = FakeStorage()
+    monkeypatch.setattr(main, "sheet_storage", storage)
+    monkeypatch.setattr(main.sheet_delta_sync, "sheets", set())
+    monkeypatch.setattr(main, "sheet_cache", {})
+    monkeypatch.setattr(main, "personalized_menu_cache", main.PersonalizedMenuCache(16))
+    return storage
+
+
+def test_repeat_menu_views_are_served_from_memory(storage):
+    client = TestClient(main.app)
+
+    first = client.get("/api/menu", params={"customer_email": "A@x.com"}).json()
+    reads = len(storage.reads)
+    second = client.get("/api/menu", params={"customer_email": "a@x.com"}).json()
+
+    assert second == first
+    assert len(storage.reads) == reads
+    assert storage.reads.count("menu") == 1
+    assert main.personalized_menu_cache.stats["hits"] == 1
+
+
+def test_menu_is_priced_from_the_menu_sheet(storage):
+    menu = TestClient(main.app).get("/api/menu", params={"customer_email": "a@x.com"}).json()
+
+    # Rows without a usable price/time are skipped; paneer is preferred and on top
+    assert [m["Dish"] for m in menu] == ["Paneer Tikka", "Dal Tadka"]
+    assert menu[0] == {
+        "Dish": "Paneer Tikka", "Category": "Starter", "BasePrice": 200.0,
+        "SurgeApplied": False, "Time": 15, "Price": 205.0, "Personalized": True,
+    }
+    assert menu[1]["Price"] == 145.0
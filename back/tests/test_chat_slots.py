@@ -0,0 +1,52 @@
+from main import NO_SLOTS, ChatSlots, OrderSlot
+
+
+def test_booking_slots_are_normalized():
+    slots = ChatSlots.from_json({
+        "intent": "book_table",
+        "name": "  priya sharma ",
+        "email": "Priya@Example.COM",
+        "people": "4",
+        "date": "2026-10-20",
+        "time": "8:00 PM",
+    })
+    assert slots == ChatSlots(
+        name="Priya Sharma", email="priya@example.com", people=4, date="2026-10-20", time="8:00 pm"
+    )
+
+
+def test_missing_and_null_slots_stay_empty():
+    assert ChatSlots.from_json({"intent": "general_chat"}) == NO_SLOTS
+    assert ChatSlots.from_json({"name": None, "email": "  ", "people": None, "dishes": None}) == NO_SLOTS
+
+
+def test_invalid_values_are_dropped():
+    slots = ChatSlots.from_json({"people": 0, "date": "tomorrow", "time": ""})
+    assert slots.people is None
+    assert slots.date is None
+    assert slots.time is None
+    assert ChatSlots.from_json({"people": "a few"}).people is None
+
+
+def test_dishes_keep_order_and_default_quantity():
+    slots = ChatSlots.from_json({"dishes": [
+        {"dish": " Dal Tadka ", "quantity": 2, "toppings": "extra butter"},
+        {"dish": "Butter Naan", "quantity": None},
+        {"dish": "Jeera Rice", "quantity": "three"},
+    ]})
+    assert slots.dishes == (
+        OrderSlot("Dal Tadka", 2, "extra butter"),
+        OrderSlot("Butter Naan", 1),
+        OrderSlot("Jeera Rice", 1),
+    )
+
+
+def test_unusable_dishes_are_skipped():
+    slots = ChatSlots.from_json({"dishes": [
+        "Dal Tadka",
+        {"dish": "", "quantity": 1},
+        {"quantity": 2},
+        {"dish": "Paneer Tikka", "quantity": -1},
+        {"dish": "Paneer Tikka", "quantity": 1, "toppings": None},
+    ]})
+    assert slots.dishes == (OrderSlot("Paneer Tikka", 1),)
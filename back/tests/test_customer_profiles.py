@@ -0,0 +1,37 @@
+import pytest
+
+import main
+from main import CustomerProfileStore
+
+
+@pytest.fixture
+def profiles(monkeypatch):
+    monkeypatch.setattr(main, "sheet_indexes", {})
+    return CustomerProfileStore()
+
+
+def order(dish, ordered_at, customer="A@X.com"):
+    return {"Customer_ID": customer, "Dish": dish, "Ordered_At": ordered_at}
+
+
+def test_taste_comes_from_the_latest_three_orders(profiles):
+    profiles._sync([
+        order("Paneer Tikka", "2025-01-01 12:00"),
+        order("Paneer Butter Masala", "2025-01-02 12:00"),
+        order("Dal Tadka", "2025-01-03 12:00"),
+        order("Dal Makhani", "2025-01-04 12:00"),
+        order("Jeera Rice", "2025-01-05 12:00"),
+    ])
+    assert profiles.order_count("a@x.com") == 5
+    assert profiles.favourite("a@x.com") == "dal"
+    assert profiles.preferred_keywords("a@x.com") == {"dal", "rice"}
+
+
+def test_refresh_only_reads_new_orders(profiles):
+    rows = [order("Paneer Tikka", "2025-01-01 12:00"), order("Dal Tadka", "2025-01-02 12:00")]
+    profiles._sync(rows)
+    profiles._sync(rows + [order("Chicken Biryani", "2025-01-03 12:00", customer="b@x.com")])
+
+    assert profiles.stats == {"rebuilds": 1, "incremental_rows": 1}
+    assert profiles.order_count("a@x.com") == 2
+    assert profiles.order_count("b@x.com") == 1
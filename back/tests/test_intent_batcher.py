@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+import main
+from main import INTENT_BATCH_SCHEMA, IntentBatcher
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Fake call_gemini_json: batched replies come from `batch_reply`, single calls from `single`."""
+    calls = []
+    fake = {"batch_reply": None, "single": {}}
+
+    async def call_gemini_json(prompt, schema):
+        calls.append((prompt, schema))
+        if schema is INTENT_BATCH_SCHEMA:
+            return fake["batch_reply"]
+        for message, reply in fake["single"].items():
+            if f'User message: "{message}"' in prompt:
+                return reply
+        return None
+
+    monkeypatch.setattr(main, "call_gemini_json", call_gemini_json)
+    fake["calls"] = calls
+    return fake
+
+
+def classify_all(batcher, messages):
+    async def run():
+        return await asyncio.gather(*(batcher.classify(m, "No booking") for m in messages))
+
+    return asyncio.run(run())
+
+
+def batch_calls(gemini):
+    return [prompt for prompt, schema in gemini["calls"] if schema is INTENT_BATCH_SCHEMA]
+
+
+def test_results_go_to_their_own_caller_in_any_order(gemini):
+    gemini["batch_reply"] = {"results": [
+        {"index": 2, "intent": "location"},
+        {"index": 0, "intent": "menu_info"},
+        {"index": 1, "intent": "complaint"},
+    ]}
+    batcher = IntentBatcher(window=0.05, max_size=8)
+
+    predictions = classify_all(batcher, ["what's on the menu", "my food was cold", "where are you"])
+
+    assert [p.intent for p in predictions] == ["menu_info", "complaint", "location"]
+    assert len(gemini["calls"]) == 1
+    assert batcher.stats["batches"] == 1
+    assert batcher.stats["flush_window"] == 1
+
+
+def test_missing_or_invalid_entries_fall_back_to_a_single_call(gemini):
+    gemini["batch_reply"] = {"results": [{"index": 0, "intent": "menu_info"}, {"index": 1, "intent": "nonsense"}]}
+    gemini["single"] = {
+        "pay by cash": {"intent": "payment_mode"},
+        "hello there": {"intent": "general_chat"},
+    }
+    batcher = IntentBatcher(window=0.05, max_size=8)
+
+    predictions = classify_all(batcher, ["show me the menu", "pay by cash", "hello there"])
+
+    assert [p.intent for p in predictions] == ["menu_info", "payment_mode", "general_chat"]
+    assert batcher.stats["fallbacks"] == 2
+    assert len(batch_calls(gemini)) == 1
+
+
+def test_failed_batch_classifies_every_message_alone(gemini):
+    gemini["single"] = {"hi": {"intent": "general_chat"}, "menu please": {"intent": "menu_info"}}
+    batcher = IntentBatcher(window=0.05, max_size=8)
+
+    predictions = classify_all(batcher, ["hi", "menu please"])
+
+    assert [p.intent for p in predictions] == ["general_chat", "menu_info"]
+    assert batcher.stats["failed_batches"] == 1
+    assert batcher.stats["fallbacks"] == 2
+
+
+def test_slots_only_come_from_the_customers_own_message(gemini):
+    # The shared reply tries to hand message 1 the details from message 0
+    gemini["batch_reply"] = {"results": [
+        {"index": 0, "intent": "general_chat", "email": "a@x.com"},
+        {"index": 1, "intent": "book_table", "name": "Asha", "email": "a@x.com", "people": 4},
+    ]}
+    gemini["single"] = {"table for 2, b@y.com": {"intent": "book_table", "people": 2, "email": "b@y.com"}}
+    batcher = IntentBatcher(window=0.05, max_size=8)
+
+    chat, booking = classify_all(batcher, ["I'm Asha, a@x.com, 4 people", "table for 2, b@y.com"])
+
+    assert chat.intent == "general_chat"
+    assert chat.slots == main.NO_SLOTS
+    assert booking.intent == "book_table"
+    assert booking.slots.email == "b@y.com"
+    assert booking.slots.people == 2
+    assert booking.slots.name is None
+    assert batcher.stats["slot_followups"] == 1
+    # The batched prompt asks for intents only
+    assert "Details to extract" not in batch_calls(gemini)[0]
+
+
+def test_full_batch_flushes_without_waiting_for_the_window(gemini):
+    gemini["batch_reply"] = {"results": [{"index": i, "intent": "menu_info"} for i in range(3)]}
+    batcher = IntentBatcher(window=10, max_size=3)
+
+    async def run():
+        return await asyncio.wait_for(
+            asyncio.gather(*(batcher.classify(f"menu {i}", "No booking") for i in range(3))), timeout=2
+        )
+
+    predictions = asyncio.run(run())
+
+    assert [p.intent for p in predictions] == ["menu_info"] * 3
+    assert batcher.stats["flush_full"] == 1
+    assert batcher.stats["flush_window"] == 0
+
+
+def test_batch_of_one_skips_the_batched_prompt(gemini):
+    gemini["single"] = {"menu please": {"intent": "menu_info"}}
+    batcher = IntentBatcher(window=0.01, max_size=8)
+
+    (prediction,) = classify_all(batcher, ["menu please"])
+
+    assert prediction.intent == "menu_info"
+    assert batch_calls(gemini) == []
+    assert batcher.stats["fallbacks"] == 0
@@ -0,0 +1,90 @@
+import pytest
+
+from main import INTENT_LOCAL_MIN_CONFIDENCE, LocalIntentClassifier, local_intent_classifier
+
+
+def confident_intent(message):
+    """The intent the local tier would answer with, or None if it defers to Gemini."""
+    prediction = local_intent_classifier.predict(message)
+    if prediction and prediction.confidence >= INTENT_LOCAL_MIN_CONFIDENCE:
+        return prediction.intent
+    return None
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("cash", "payment_mode"),
+    ("Pay by cash", "payment_mode"),
+    ("online!", "payment_mode"),
+    ("hi", "general_chat"),
+    ("Thank you!", "general_chat"),
+    ("where is my table?", "guide_table"),
+    ("please guide me to my booked table", "guide_table"),
+    ("cancel my food order", "cancel_order"),
+    ("cancel my booking", "cancel_booking"),
+    ("I want to meet the manager", "meet_manager"),
+    ("Please send your manager", "meet_manager"),
+    ("Can I talk to staff?", "meet_manager"),
+    ("show me the menu", "menu_info"),
+    ("where are you located?", "location"),
+    ("What is your address", "location"),
+    ("where is the restaurant", "location"),
+])
+def test_rules_answer_clear_messages(message, intent):
+    prediction = local_intent_classifier.predict(message)
+    assert prediction.tier == "rules"
+    assert prediction.intent == intent
+    assert prediction.confidence >= INTENT_LOCAL_MIN_CONFIDENCE
+
+
+@pytest.mark.parametrize("message, wrong_intent", [
+    # Replies to the booking handler's "share your email address"
+    ("my email address is a@b.com", "location"),
+    ("book a table for 4 today at 8pm, email address john@x.com", "location"),
+    ("what is the location of my table", "location"),
+    # Complaints that merely mention the manager
+    ("the manager was rude", "meet_manager"),
+    ("I want to complain about the manager", "meet_manager"),
+])
+def test_keyword_mentions_are_not_misrouted(message, wrong_intent):
+    assert confident_intent(message) != wrong_intent
+
+
+@pytest.mark.parametrize("message", [
+    # Negations of an action the handler would carry out
+    "don't cancel my booking",
+    "I do not want to cancel my order",
+    "I don't want to pay cash",
+    # A dish, not a request for the manager
+    "can i see the manager's special",
+    # Complaints that mention the table
+    "where is my table? the food was cold",
+    "the naan is cold and my table is wobbly",
+    # Two requests in one message
+    "Cancel my booking and order 2 naan",
+])
+def test_misleading_messages_defer_to_gemini(message):
+    assert confident_intent(message) is None
+
+
+def test_model_never_answers_intents_with_side_effects():
+    classifier = LocalIntentClassifier([("pay with card please", "payment_mode")], [])
+    assert classifier.predict("pay with card please") is None
+
+
+def test_model_is_not_overconfident_on_short_messages():
+    # Near-certain before the temperature was added
+    for message in ["the food was cold", "what do you have", "which table is mine"]:
+        prediction = local_intent_classifier.predict(message)
+        assert prediction.tier == "model"
+        assert prediction.confidence < INTENT_LOCAL_MIN_CONFIDENCE
+
+
+def test_unknown_words_defer_to_gemini():
+    assert local_intent_classifier.predict("zxqv plorb") is None
+    assert local_intent_classifier.predict("") is None
+
+
+def test_model_tier_confidence_is_a_probability():
+    prediction = local_intent_classifier.predict("I would like two plates of dal")
+    assert prediction.tier == "model"
+    assert 0 < prediction.confidence <= 1
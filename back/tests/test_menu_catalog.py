@@ -0,0 +1,51 @@
+from main import MENU_FUZZY_MIN_SCORE, MenuCatalog
+
+MENU = [
+    {"Dish": "Dal Tadka", "Category": "Main", "Price": "₹180"},
+    {"Dish": "Paneer Butter Masala", "Category": "Main", "Price": "260"},
+    {"Dish": "Chicken Tikka Masala", "Category": "Main", "Price": "320"},
+    {"Dish": "Butter Naan", "Category": "Breads", "Price": "50"},
+]
+
+
+def catalog():
+    menu = MenuCatalog()
+    menu.rebuild(MENU)
+    return menu
+
+
+def test_exact_and_normalized_names_are_exact():
+    menu = catalog()
+    for name in ("Dal Tadka", "dal tadka", "  DAL-TADKA!  "):
+        match = menu.match(name)
+        assert match.exact
+        assert match.item.dish == "Dal Tadka"
+        assert match.item.price == 180.0
+
+
+def test_misspelling_is_only_a_suggestion():
+    match = catalog().match("butter nan")
+    assert match.item.dish == "Butter Naan"
+    assert not match.exact
+    assert MENU_FUZZY_MIN_SCORE <= match.score < 1.0
+
+
+def test_different_dish_with_shared_words_is_not_exact():
+    # Scores ~0.67, well above the suggestion threshold, but is another dish
+    match = catalog().match("Chicken Tikka")
+    assert match.item.dish == "Chicken Tikka Masala"
+    assert not match.exact
+
+
+def test_nothing_close_enough_returns_none():
+    menu = catalog()
+    assert menu.match("Pizza") is None
+    assert menu.match("") is None
+    assert menu.match("butter nan", min_score=0.99) is None
+
+
+def test_duplicate_dish_rows_keep_the_first():
+    menu = MenuCatalog()
+    menu.rebuild(MENU + [{"Dish": "dal tadka", "Price": "999"}])
+    assert menu.match("Dal Tadka").item.price == 180.0
+    assert len(menu.items) == len(MENU)
@@ -0,0 +1,53 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+SHEETS = {
+    "menu": [
+        {"Dish": "Dal Tadka", "Category": "Main Course", "Price": "150", "Time": "20"},
+        {"Dish": "Butter Naan", "Category": "Breads", "Price": "40", "Time": "10"},
+    ],
+    "table": [{"Table": "T1", "Availability": "No"}, {"Table": "T2", "Availability": "Yes"}],
+    "orders": [],
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    appended = []
+    monkeypatch.setattr(main, "current_sheet_rows", lambda sheet_name: SHEETS[sheet_name])
+    monkeypatch.setattr(main, "get_active_booking", lambda email: {"Table_No": "T1"})
+    monkeypatch.setattr(main, "append_rows_to_sheet", lambda sheet_name, rows: appended.extend(rows))
+    client = TestClient(main.app)
+    client.appended = appended
+    return client
+
+
+def order(*items):
+    return {
+        "session_id": "s1", "name": "Asha", "email": "a@x.com",
+        "items": [{"id": str(i), "name": name, "price": 1, "quantity": qty} for i, (name, qty) in enumerate(items)],
+    }
+
+
+def test_unknown_items_are_rejected_with_a_message_for_the_cart(client):
+    response = client.post("/order", json=order(("Dal Tadka", 1), ("Dal Tadkaa", 2), ("Sushi", 1)))
+
+    assert response.status_code == 422
+    body = response.json()
+    assert body["unknown_items"] == {"Dal Tadkaa": "Dal Tadka", "Sushi": None}
+    assert "Did you mean **Dal Tadka**?" in body["response"]
+    assert "'Sushi' isn’t on our menu" in body["response"]
+    assert client.appended == []
+
+
+def test_exact_items_are_ordered_at_server_prices(client):
+    response = client.post("/order", json=order(("dal tadka", 2), ("Butter Naan", 1)))
+
+    assert response.status_code == 200
+    assert response.json()["awaiting_payment_mode"] is True
+    assert [(row["Dish"], row["Quantity"], row["Price"]) for row in client.appended] == [
+        ("Dal Tadka", 2, "₹150 × 2 = ₹300"),
+        ("Butter Naan", 1, "₹40 × 1 = ₹40"),
+    ]
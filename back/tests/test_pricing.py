@@ -0,0 +1,50 @@
+import random
+
+import numpy as np
+import pytest
+
+from main import CustomerPricing, MenuPriceVector, PricingEngine
+
+DISHES = ["Paneer Tikka", "Dal Tadka", "Jeera Rice", "Chicken Biryani", "Mutton Rogan Josh", "Butter Naan", " dal makhani "]
+
+CUSTOMERS = [
+    CustomerPricing(),
+    CustomerPricing(loyalty=1.05),
+    CustomerPricing(personalized=True, preferred_keywords=frozenset({"dal"}), preferred_markup=5, other_discount=5),
+    CustomerPricing(
+        loyalty=1.05, personalized=True, preferred_keywords=frozenset({"paneer", "rice"}),
+        preferred_markup=10, other_discount=5,
+    ),
+    # Discount bigger than some prices: clamped at 0
+    CustomerPricing(personalized=True, preferred_keywords=frozenset({"naan"}), preferred_markup=5, other_discount=500),
+    # Personalized with no matching dish
+    CustomerPricing(personalized=True, preferred_keywords=frozenset({"sushi"}), preferred_markup=5, other_discount=5),
+]
+
+
+@pytest.mark.parametrize("customer", CUSTOMERS)
+@pytest.mark.parametrize("surge", [1.0, 1.2])
+def test_vector_pricing_matches_unit_price(customer, surge):
+    rng = random.Random(7)
+    base = [rng.choice([0, 40, 99.5, 150, 249, 480]) for _ in DISHES]
+    engine = PricingEngine(surge, customer)
+
+    prices, preferred = MenuPriceVector(DISHES, base).price(customer, surge)
+
+    expected = [engine.unit_price(dish, price) for dish, price in zip(DISHES, base)]
+    assert prices.tolist() == [price for price, _ in expected]
+    assert preferred.tolist() == [flag for _, flag in expected]
+
+
+def test_keyword_masks_are_reused_across_customers():
+    vector = MenuPriceVector(DISHES, [100] * len(DISHES))
+    first = vector.preferred_mask({"dal"})
+    second = vector.preferred_mask({"dal", "rice"})
+    assert first.tolist() == [False, True, False, False, False, False, True]
+    assert np.count_nonzero(second) == 3
+    assert set(vector._keyword_masks) == {"dal", "rice"}
+
+
+def test_empty_menu_prices_to_empty_arrays():
+    prices, preferred = MenuPriceVector([], []).price(CUSTOMERS[3], 1.2)
+    assert prices.shape == preferred.shape == (0,)
@@ -0,0 +1,84 @@
+import pytest
+
+import main
+from main import BookingIndex, SheetIndex
+
+
+class RecordingIndex(SheetIndex):
+    def __init__(self):
+        super().__init__("recording")
+        self.rows = []
+
+    def rebuild(self, rows):
+        self.rows = list(rows)
+
+    def add_row(self, row):
+        self.rows.append(row)
+
+
+@pytest.fixture(autouse=True)
+def own_registry(monkeypatch):
+    monkeypatch.setattr(main, "sheet_indexes", {})
+
+
+def booking(email, day):
+    return {"Email": email, "Date": day, "Time": "8:00 pm", "Table_No": "T1"}
+
+
+def test_delta_sync_only_adds_the_new_rows():
+    index = RecordingIndex()
+    rows = [{"id": 1}, {"id": 2}]
+    index._sync(rows)
+    # What DeltaSheetSync hands out: the same row objects plus the new ones
+    index._sync(rows + [{"id": 3}])
+    index._sync(rows + [{"id": 3}])  # an empty delta still makes a new list
+
+    assert index.rows == [{"id": 1}, {"id": 2}, {"id": 3}]
+    assert index.stats == {"rebuilds": 1, "incremental_rows": 1}
+
+
+def test_unchanged_full_resync_does_not_rebuild():
+    index = RecordingIndex()
+    index._sync([{"id": 1}, {"id": 2}])
+    index._sync([{"id": 1}, {"id": 2}])
+    assert index.stats["rebuilds"] == 1
+
+
+@pytest.mark.parametrize("changed", [
+    [{"id": 1}, {"id": 20}],  # edited
+    [{"id": 1}],              # shrank
+    [{"id": 2}, {"id": 1}],   # shifted
+])
+def test_changed_rows_rebuild(changed):
+    index = RecordingIndex()
+    index._sync([{"id": 1}, {"id": 2}])
+    index._sync(changed)
+    assert index.rows == changed
+    assert index.stats["rebuilds"] == 2
+
+
+def test_header_and_list_rows_become_records():
+    index = RecordingIndex()
+    rows = [["id", "name"], [1, "a"]]
+    index._sync(rows)
+    index._sync(rows + [[2, "b"]])
+    assert index.rows[-1] == {"id": 2, "name": "b"}
+    assert index.stats["rebuilds"] == 1
+
+
+def test_booking_index_parses_existing_rows_once(monkeypatch):
+    parsed = []
+    parse = main.parse_booking_datetime
+
+    def counting_parse(rec):
+        parsed.append(rec["Email"])
+        return parse(rec)
+
+    monkeypatch.setattr(main, "parse_booking_datetime", counting_parse)
+    index = BookingIndex()
+    rows = [booking("a@x.com", "2025-01-01"), booking("b@x.com", "2025-01-02")]
+    index._sync(rows)
+    index._sync(rows + [booking("c@x.com", "2025-01-03")])
+
+    assert parsed == ["a@x.com", "b@x.com", "c@x.com"]
+    assert index.latest("c@x.com")["Date"] == "2025-01-03"
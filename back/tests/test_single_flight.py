@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from main import SingleFlight
+
+
+def test_sync_followers_share_the_leaders_result():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait(2)
+        return "rows"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.run("menu", fetch))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join(2)
+
+    assert results == ["rows"] * 5
+    assert len(calls) == 1
+    assert flight.stats["coalesced"] == 4
+    assert flight.info()["in_flight"] == []
+
+
+def test_sync_leader_error_reaches_followers():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def fetch():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("sheet down")
+
+    errors = []
+
+    def follower():
+        started.wait(2)
+        try:
+            flight.run("menu", lambda: "unused")
+        except ValueError as e:
+            errors.append(str(e))
+
+    t = threading.Thread(target=follower)
+    t.start()
+    with pytest.raises(ValueError):
+        flight.run("menu", fetch)
+    t.join(2)
+    assert errors == ["sheet down"]
+
+
+def test_async_followers_share_one_fetch():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "rows"
+
+    async def main():
+        return await asyncio.gather(*(flight.arun("menu", fetch) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["rows"] * 5
+    assert len(calls) == 1
+
+
+def test_cancelled_async_follower_does_not_cancel_the_flight():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "rows"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.arun("menu", fetch))
+        follower = asyncio.ensure_future(flight.arun("menu", fetch))
+        await asyncio.sleep(0)
+        follower.cancel()
+        return await leader
+
+    assert asyncio.run(main()) == "rows"
+
+
+def test_sync_caller_on_the_leaders_loop_does_not_deadlock():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "async rows"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.arun("menu", fetch))
+        await asyncio.sleep(0)
+        # Blocking on the leader here would hang the loop it runs on
+        sync_result = flight.run("menu", lambda: "sync rows")
+        return sync_result, await leader
+
+    assert asyncio.run(asyncio.wait_for(main(), 2)) == ("sync rows", "async rows")
+    assert flight.stats["bypassed"] == 1
+
+
+def test_sync_follower_in_a_thread_waits_for_async_leader():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.1)
+        return "rows"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.arun("menu", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.to_thread(flight.run, "menu", lambda: "unused")
+        return await asyncio.gather(leader, follower)
+
+    assert asyncio.run(main()) == ["rows", "rows"]
+    assert flight.stats["coalesced"] == 1
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from main import TableInventory
+
+TABLES = [{"Table": f"T{i}", "Availability": "Yes" if i > 2 else "No"} for i in range(1, 7)]
+
+
+@pytest.fixture
+def inventory(monkeypatch):
+    rows = [dict(r) for r in TABLES]
+    writes = []
+    status = {"value": "success"}
+    delay = {"seconds": 0}
+
+    def update_sheet_rows(sheet_name, key_column, updates):
+        time.sleep(delay["seconds"])
+        writes.append(updates)
+        return {"status": status["value"]}
+
+    # Keep the inventories built here out of the app's index registry
+    monkeypatch.setattr(main, "sheet_indexes", {name: list(found) for name, found in main.sheet_indexes.items()})
+    monkeypatch.setattr(main, "current_sheet_rows", lambda sheet_name: rows)
+    monkeypatch.setattr(main, "update_sheet_rows", update_sheet_rows)
+    tables = TableInventory()
+    tables.writes, tables.write_status, tables.write_delay = writes, status, delay
+    return tables
+
+
+def test_allocate_takes_free_tables_in_sheet_order(inventory):
+    assert inventory.allocate(2) == ["T3", "T4"]
+    assert inventory.writes == [{"T3": {"Availability": "No"}, "T4": {"Availability": "No"}}]
+    assert inventory.available() == ["T5", "T6"]
+    assert inventory.demand_ratio() == pytest.approx(4 / 6)
+
+
+def test_allocate_rejects_when_not_enough_are_free(inventory):
+    assert inventory.allocate(5) is None
+    assert inventory.allocate(0) is None
+    assert inventory.writes == []
+    assert inventory.stats["rejections"] == 2
+
+
+def test_release_returns_tables_to_the_pool(inventory):
+    tables = inventory.allocate(3)
+    inventory.release(tables)
+    assert inventory.available() == ["T3", "T4", "T5", "T6"]
+    assert inventory.writes[-1] == {t: {"Availability": "Yes"} for t in tables}
+
+
+def test_failed_write_claims_nothing(inventory):
+    inventory.write_status["value"] = "error"
+    with pytest.raises(HTTPException):
+        inventory.allocate(2)
+    assert inventory.available() == ["T3", "T4", "T5", "T6"]
+    assert inventory.info()["claimed"] == 0
+    # The attempted "No" write is undone in case part of it landed
+    assert inventory.writes[-1] == {"T3": {"Availability": "Yes"}, "T4": {"Availability": "Yes"}}
+
+
+def test_concurrent_allocations_never_share_a_table(inventory):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(inventory.allocate(1))) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(2)
+
+    granted = [r[0] for r in results if r]
+    assert sorted(granted) == ["T3", "T4", "T5", "T6"]
+    assert results.count(None) == 6
+
+
+def test_claims_survive_a_refresh_that_raced_the_write(inventory, monkeypatch):
+    inventory.allocate(1)
+    stale = [dict(r) for r in TABLES]  # still says T3 is free
+    monkeypatch.setattr(main, "current_sheet_rows", lambda sheet_name: stale)
+    inventory.ensure()
+    assert "T3" not in inventory.available()
+
+
+def test_demand_queries_do_not_wait_for_a_slow_write(inventory):
+    inventory.write_delay["seconds"] = 1.0
+    booking = threading.Thread(target=inventory.allocate, args=(2,))
+    booking.start()
+    time.sleep(0.1)  # the write is in flight
+
+    started = time.monotonic()
+    ratio = inventory.ensure().demand_ratio()
+    elapsed = time.monotonic() - started
+    booking.join(2)
+
+    assert elapsed < 0.2
+    # The reservation is already visible while the write is in flight
+    assert ratio == pytest.approx(4 / 6)
+    assert inventory.available() == ["T5", "T6"]
+
+
+def test_failed_slow_write_frees_the_reservation(inventory):
+    inventory.write_delay["seconds"] = 0.3
+    inventory.write_status["value"] = "error"
+    errors = []
+
+    def book():
+        try:
+            inventory.allocate(1)
+        except HTTPException as e:
+            errors.append(e)
+
+    booking = threading.Thread(target=book)
+    booking.start()
+    time.sleep(0.1)
+    assert "T3" not in inventory.available()
+    booking.join(2)
+
+    assert len(errors) == 1
+    assert inventory.available() == ["T3", "T4", "T5", "T6"]